@@ -4,7 +4,8 @@ from __future__ import annotations
 import re
 import traceback
 from abc import ABCMeta
-from typing import Any, Dict, Iterator, Tuple, Type, Union
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional, Tuple, Type, Union
 
 from sqlalchemy import create_engine
 from sqlalchemy.dialects.sqlite.pysqlite import SQLiteDialect_pysqlite
@@ -12,7 +13,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.sql.schema import Column, Table
-from sqlalchemy.sql.sqltypes import Enum, SchemaType, TypeDecorator
+from sqlalchemy.sql.sqltypes import DateTime, Enum, SchemaType, TypeDecorator
 
 from exceptions import EnumParsingException, FailedToSpawnDBSession
 
@@ -45,7 +46,7 @@ def create_session(db_string: str, drop_tables: bool = False) -> scoped_session:
     try:
         # In testing, we want to maintain same memory variable
         if db_engine is None or 'TESTING' not in os.environ or os.environ['TESTING'] == 'False':
-            db_engine = create_engine(db_string, convert_unicode=True)
+            db_engine = create_engine(db_string, convert_unicode=True, query_cache_size=1200)
         db_session = scoped_session(sessionmaker(bind=db_engine))
         Base.query = db_session.query_property()
 
@@ -163,6 +164,8 @@ class DeclEnum(object, metaclass=EnumMeta):
 class DeclEnumType(SchemaType, TypeDecorator):
     """Declarative enumeration type."""
 
+    cache_ok = True
+
     def __init__(self, enum: Any) -> None:
         self.enum = enum
         self.impl = Enum(
@@ -188,3 +191,16 @@ class DeclEnumType(SchemaType, TypeDecorator):
         if value is None:
             return None
         return self.enum.from_string(value.strip())
+
+
+class UTCDateTime(TypeDecorator):
+    """Timezone-aware datetime type that marks naive values loaded from the database as UTC."""
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_result_value(self, value: Optional[datetime], dialect: SQLiteDialect_pysqlite) -> Optional[datetime]:
+        """Get process result value."""
+        if value is not None and value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
@@ -8,6 +8,7 @@ from flask import (Blueprint, Response, abort, g, jsonify, make_response,
                    redirect, request, url_for)
 from github import GitHub
 from sqlalchemy import and_, func
+from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import label
 
 from decorators import template_renderer
@@ -51,7 +52,7 @@ def index():
     """Show index page for tests."""
     fork = Fork.query.filter(Fork.github.like(f"%/{g.github['repository_owner']}/{g.github['repository']}.git")).first()
     return {
-        'tests': Test.query.order_by(Test.id.desc()).limit(50).all(),
+        'tests': Test.query.options(joinedload(Test.fork)).order_by(Test.id.desc()).limit(50).all(),
         'TestType': TestType,
         'fork': fork
     }
@@ -116,6 +117,7 @@ def get_data_for_test(test, title=None) -> Dict[str, Any]:
         minutes = (total % 3600) // 60
         hours = total // 3600
 
+    regression_ids = set(test.iter_customized_regressiontest_ids())
     results = [{
         'category': category,
         'tests': [{
@@ -124,7 +126,7 @@ def get_data_for_test(test, title=None) -> Dict[str, Any]:
             'files': TestResultFile.query.filter(
                 and_(TestResultFile.test_id == test.id, TestResultFile.regression_test_id == rt.id)
             ).all()
-        } for rt in category.regression_tests if rt.id in test.get_customized_regressiontests()]
+        } for rt in category.regression_tests if rt.id in regression_ids]
     } for category in categories]
     # Run through the categories to see if they should be marked as failed or passed. A category failed if one or more
     # tests in said category failed.
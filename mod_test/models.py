@@ -10,22 +10,88 @@ List of models corresponding to mysql tables:
     ]
 """
 
+import base64
+import codecs
 import datetime
+import hashlib
+import io
+import math
 import os
-import string
-from typing import Any, Dict, List, Tuple, Type, Union
-
-import pytz
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text, orm
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Tuple, Type, Union
+
+from flask import g, has_app_context
+from sqlalchemy import (Column, ForeignKey, Integer, String, Text, func,
+                        inspect, select)
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
-from tzlocal import get_localzone
 
 import database
 import mod_regression.models
-from database import Base, DeclEnum
+from database import Base, DeclEnum, UTCDateTime
 from mod_regression.models import RegressionTest
 from mod_test.nicediff import diff
 
+# Folder (relative to the result files) in which generated HTML diffs are cached
+DIFF_CACHE_FOLDER = '_diff_cache'
+# Bump whenever the HTML produced by nicediff changes, so diffs cached by an older version are no longer served
+DIFF_CACHE_VERSION = 1
+# Cached diffs older than this many seconds, or beyond the newest DIFF_CACHE_MAX_ENTRIES, are removed
+DIFF_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+DIFF_CACHE_MAX_ENTRIES = 1000
+
+
+class _TokenPool(threading.local):
+    """Per-thread buffer of random bytes, refilled from os.urandom in bulk."""
+
+    refill_size = 4096
+
+    def __init__(self) -> None:
+        self.buffer = b''
+        self.offset = 0
+        self.pid = os.getpid()
+
+    def take(self, size: int) -> bytes:
+        """
+        Take size random bytes from the pool, refilling it when needed.
+
+        :param size: The number of bytes to take.
+        :type size: int
+        :return: Random bytes
+        :rtype: bytes
+        """
+        # A forked worker must never hand out the same bytes as its parent
+        if self.pid != os.getpid() or len(self.buffer) - self.offset < size:
+            self.buffer = os.urandom(max(self.refill_size, size))
+            self.offset = 0
+            self.pid = os.getpid()
+        chunk = self.buffer[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+
+_token_pool = _TokenPool()
+
+
+def _primary_key(instance: Any) -> Any:
+    """
+    Get the primary key of a model instance without loading it from the database.
+
+    Reading the id of an expired instance (e.g. after a commit) would refresh it, so the identity key is used when the
+    id is not loaded.
+
+    :param instance: The model instance.
+    :type instance: Any
+    :return: The primary key value of the instance
+    :rtype: Any
+    """
+    loaded = instance.__dict__
+    if 'id' in loaded:
+        return loaded['id']
+    identity = inspect(instance).identity
+    return instance.id if identity is None else identity[0]
+
 
 class TestPlatform(DeclEnum):
     """Enum to specify system platforms."""
@@ -50,6 +116,9 @@ class TestStatus(DeclEnum):
     completed = "completed", "Completed"
     canceled = "canceled", "Canceled/Error"
 
+    # Progress step of each stage, filled in once the stages are defined below
+    _STEP_IDX: Dict[Any, int]
+
     @staticmethod
     def progress_step(inst) -> Any:
         """
@@ -60,21 +129,24 @@ class TestStatus(DeclEnum):
         :return: name of the stage
         :rtype: enum
         """
-        try:
-            return TestStatus.stages().index(inst)
-        except ValueError:
-            return -1
+        return TestStatus._STEP_IDX.get(inst, -1)
 
     @staticmethod
-    def stages() -> List[Tuple[str, str]]:
+    def stages() -> Tuple[Any, ...]:
         """
         Define stages for the test.
 
         :return: stages available for test
-        :rtype: list
+        :rtype: tuple
         """
-        return [TestStatus.preparation, TestStatus.building,
-                TestStatus.testing, TestStatus.completed]
+        return _STAGES
+
+
+_STAGES = (TestStatus.preparation, TestStatus.building, TestStatus.testing, TestStatus.completed)
+TestStatus._STEP_IDX = {stage: index for index, stage in enumerate(_STAGES)}
+_TERMINAL_STATUSES = frozenset((TestStatus.completed, TestStatus.canceled))
+_ALL_REGRESSION_IDS = select(RegressionTest.id)
+_BOM_ENCODINGS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
 
 
 class Fork(Base):
@@ -91,18 +163,28 @@ class Fork(Base):
 
     def __repr__(self) -> str:
         """Represent fork with fork id."""
-        return f"<Fork {self.id}>"
+        return f"<Fork {_primary_key(self)}>"
 
-    @property
+    @hybrid_property
     def github_url(self):
         """Get GitHub url of the fork."""
         return self.github.replace('.git', '')
 
-    @property
+    @github_url.expression  # type: ignore
+    def github_url(cls):
+        """Get GitHub url of the fork as an SQL expression."""
+        return func.replace(cls.github, '.git', '')
+
+    @hybrid_property
     def github_name(self):
         """Get GitHub name of the fork's user."""
         return self.github_url.replace("https://github.com/", '')
 
+    @github_name.expression  # type: ignore
+    def github_name(cls):
+        """Get GitHub name of the fork's user as an SQL expression."""
+        return func.replace(cls.github_url, "https://github.com/", '')
+
 
 class Test(Base):
     """Model to store and manage test."""
@@ -118,8 +200,8 @@ class Test(Base):
     branch = Column(Text(), nullable=False)
     commit = Column(String(64), nullable=False)
     pr_nr = Column(Integer(), nullable=False, default=0)
-    customized_tests = relationship('CustomizedTest', back_populates='test')
-    progress = relationship('TestProgress', back_populates='test', order_by='TestProgress.id')
+    customized_tests = relationship('CustomizedTest', back_populates='test', lazy='selectin')
+    progress = relationship('TestProgress', back_populates='test', order_by='TestProgress.id', lazy='selectin')
     results = relationship('TestResult', back_populates='test')
 
     def __init__(self, platform, test_type, fork_id, branch, commit, pr_nr=0, token=None) -> None:
@@ -159,7 +241,18 @@ class Test(Base):
         :return: Returns the string containing 'id' field of the Test model
         :rtype: str
         """
-        return f"<TestEntry {self.id}>"
+        return f"<TestEntry {_primary_key(self)}>"
+
+    @property
+    def _last_progress(self):
+        """
+        Get the most recent progress entry of the Test.
+
+        :return: The last TestProgress of the Test, or None if there is none yet
+        :rtype: TestProgress
+        """
+        progress = self.progress
+        return progress[-1] if progress else None
 
     @property
     def finished(self):
@@ -169,9 +262,8 @@ class Test(Base):
         :return: Checks if Test is completed or cancelled
         :rtype: boolean
         """
-        if len(self.progress) > 0:
-            return self.progress[-1].status in [TestStatus.completed, TestStatus.canceled]
-        return False
+        last_progress = self._last_progress
+        return last_progress is not None and last_progress.status in _TERMINAL_STATUSES
 
     @property
     def failed(self):
@@ -181,9 +273,8 @@ class Test(Base):
         :return: Checks if Test is canceled
         :rtype: boolean
         """
-        if len(self.progress) > 0:
-            return self.progress[-1].status == TestStatus.canceled
-        return False
+        last_progress = self._last_progress
+        return last_progress is not None and last_progress.status == TestStatus.canceled
 
     @property
     def github_link(self):
@@ -206,35 +297,45 @@ class Test(Base):
         """
         Generate progress report for the Test Model.
 
+        The report is kept on the instance and only rebuilt once the progress of the Test changes. Callers get a copy,
+        so changing the returned report does not affect later calls.
+
         :return: progress, stages, start and end time of Test Model
         :rtype: dict
         """
-        result: Dict[str, Union[Dict[str, Union[str, int]], List[Tuple[str, str]], str]] = {
-            'progress': {
-                'state': 'error',
-                'step': -1
-            },
-            'stages': TestStatus.stages(),
-            'start': '-',
-            'end': '-'
-        }
+        progress = self.progress
+        cache_key = (len(progress), progress[-1].id if len(progress) > 0 else None)
+        cached: Any = getattr(self, '_progress_data_cache', None)
+        if cached is None or cached[0] != cache_key:
+            report: Dict[str, Union[Dict[str, Union[str, int]], Tuple[Any, ...], str]] = {
+                'progress': {
+                    'state': 'error',
+                    'step': -1
+                },
+                'stages': TestStatus.stages(),
+                'start': '-',
+                'end': '-'
+            }
+
+            if len(progress) > 0:
+                report['start'] = progress[0].timestamp
+                last_status = progress[-1]
 
-        if len(self.progress) > 0:
-            result['start'] = self.progress[0].timestamp
-            last_status = self.progress[-1]
+                if last_status.status in _TERMINAL_STATUSES:
+                    report['end'] = last_status.timestamp
 
-            if last_status.status in [TestStatus.completed, TestStatus.canceled]:
-                result['end'] = last_status.timestamp
+                if last_status.status == TestStatus.canceled:
+                    if len(progress) > 1:
+                        report['progress']['step'] = TestStatus.progress_step(progress[-2].status)  # type: ignore
 
-            if last_status.status == TestStatus.canceled:
-                if len(self.progress) > 1:
-                    result['progress']['step'] = TestStatus.progress_step(self.progress[-2].status)  # type: ignore
+                else:
+                    report['progress']['state'] = 'ok'  # type: ignore
+                    report['progress']['step'] = TestStatus.progress_step(last_status.status)   # type: ignore
 
-            else:
-                result['progress']['state'] = 'ok'  # type: ignore
-                result['progress']['step'] = TestStatus.progress_step(last_status.status)   # type: ignore
+            cached = (cache_key, report)
+            self._progress_data_cache = cached
 
-        return result
+        return {**cached[1], 'progress': dict(cached[1]['progress'])}
 
     @staticmethod
     def create_token(length: int = 64) -> str:
@@ -246,24 +347,51 @@ class Test(Base):
         :return: Randomly generated token
         :rtype: str
         """
-        chars = string.ascii_letters + string.digits
-        import os
-        return ''.join(chars[ord(os.urandom(1)) % len(chars)] for i in range(length))
+        random_bytes = _token_pool.take(math.ceil(length * 3 / 4))
+        return base64.urlsafe_b64encode(random_bytes).decode('ascii').rstrip('=')[:length]
 
     def get_customized_regressiontests(self) -> Any:
         """
         Output all customized regression ids of the test.
 
         return: Regression IDs
-        rtype: list
+        rtype: tuple
         """
         customized_test = self.customized_tests
         if len(customized_test) != 0:
-            regression_ids = [r.regression_id for r in customized_test]
+            regression_ids = tuple(r.regression_id for r in customized_test)
         else:
-            regression_ids = [r.id for r in RegressionTest.query.all()]
+            regression_ids = self._all_regression_ids()
         return regression_ids
 
+    def iter_customized_regressiontest_ids(self) -> Iterator[int]:
+        """
+        Iterate over all customized regression ids of the test, without building a list of them first.
+
+        :return: Regression IDs
+        :rtype: iterator
+        """
+        customized_test = self.customized_tests
+        if len(customized_test) != 0:
+            for r in customized_test:
+                yield r.regression_id
+        else:
+            yield from self._all_regression_ids()
+
+    @staticmethod
+    def _all_regression_ids() -> Tuple[int, ...]:
+        """
+        Output the ids of all regression tests, cached for the current request.
+
+        :return: Regression IDs
+        :rtype: tuple
+        """
+        if not has_app_context():
+            return tuple(RegressionTest.query.session.execute(_ALL_REGRESSION_IDS).scalars())
+        if 'all_regression_ids' not in g:
+            g.all_regression_ids = tuple(RegressionTest.query.session.execute(_ALL_REGRESSION_IDS).scalars())
+        return g.all_regression_ids
+
 
 class TestProgress(Base):
     """Model to store and manage test progress."""
@@ -274,7 +402,7 @@ class TestProgress(Base):
     test_id = Column(Integer, ForeignKey('test.id', onupdate="CASCADE", ondelete="CASCADE"))
     test = relationship('Test', uselist=False, back_populates='progress')
     status = Column(TestStatus.db_type(), nullable=False)
-    timestamp = Column(DateTime(timezone=True), nullable=False)
+    timestamp = Column(UTCDateTime(), nullable=False)
     message = Column(Text(), nullable=False)
 
     def __init__(self, test_id, status, message, timestamp=None) -> None:
@@ -292,14 +420,12 @@ class TestProgress(Base):
         """
         self.test_id = test_id
         self.status = status
-        tz = get_localzone()
 
         if timestamp is None:
-            timestamp = tz.localize(datetime.datetime.now())
-            timestamp = timestamp.astimezone(pytz.UTC)
+            timestamp = datetime.datetime.now(datetime.timezone.utc)
 
         if timestamp.tzinfo is None:
-            timestamp = pytz.utc.localize(timestamp, is_dst=False)
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
 
         self.timestamp = timestamp
         self.message = message
@@ -313,11 +439,6 @@ class TestProgress(Base):
         """
         return f"<TestStatus {self.test_id}: {self.status}>"
 
-    @orm.reconstructor
-    def may_the_timezone_be_with_it(self):
-        """Localize the timestamp to utc."""
-        self.timestamp = pytz.utc.localize(self.timestamp)
-
 
 class TestResult(Base):
     """Model to store and manage test result."""
@@ -367,6 +488,24 @@ class TestResult(Base):
                f"(expected {self.expected_rc} in {self.runtime} ms>"
 
 
+def _decode_result(data: bytes) -> str:
+    """
+    Decode the contents of a result file, picking the encoding from its BOM if there is one.
+
+    :param data: The raw contents of the file.
+    :type data: bytes
+    :return: The decoded contents.
+    :rtype: str
+    """
+    for bom, encoding in _BOM_ENCODINGS:
+        if data.startswith(bom):
+            return data.decode(encoding)
+    try:
+        return data.decode('utf8')
+    except UnicodeDecodeError:
+        return data.decode('cp1252')
+
+
 class TestResultFile(Base):
     """Model to store and manage test result file."""
 
@@ -381,7 +520,7 @@ class TestResultFile(Base):
     regression_test_output_id = Column(
         Integer, ForeignKey('regression_test_output.id', onupdate="CASCADE", ondelete="CASCADE"), primary_key=True
     )
-    regression_test_output = relationship('RegressionTestOutput', uselist=False)
+    regression_test_output = relationship('RegressionTestOutput', uselist=False, lazy='joined')
     expected = Column(Text(), nullable=False)  # Keep track of which sample was 'correct' at the time the test ran.
     got = Column(Text(), nullable=True)  # If null/empty, it's equal to the expected version
 
@@ -435,11 +574,81 @@ class TestResultFile(Base):
 
         file_ok = os.path.join(base_path, self.expected + self.regression_test_output.correct_extension)
         file_fail = os.path.join(base_path, self.got + self.regression_test_output.correct_extension)
+        cache_file = self.diff_cache_file(base_path, file_ok, file_fail, to_view)
+        # The cached diff may be pruned by another request at any time, so fall back to generating it on any error
+        try:
+            with open(cache_file, encoding='utf8') as f:
+                html_diff = f.read()
+        except OSError:
+            pass
+        else:
+            log.debug(f"Serve cached diff for {file_ok} vs {file_fail}")
+            return html_diff
+
         log.debug(f"Generate diff for {file_ok} vs {file_fail}")
         lines_ok = self.read_lines(file_ok)
         lines_fail = self.read_lines(file_fail)
+        html_diff = diff.get_html_diff(lines_ok, lines_fail, to_view)
+
+        # Write to a temporary file first so a concurrent request never reads a partial diff
+        temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(temp_file, 'w', encoding='utf8') as f:
+                f.write(html_diff)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            log.warning(f"Could not cache diff for {file_ok} vs {file_fail}: {e}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        else:
+            self.prune_diff_cache(os.path.dirname(cache_file))
 
-        return diff.get_html_diff(lines_ok, lines_fail, to_view)
+        return html_diff
+
+    @staticmethod
+    def prune_diff_cache(cache_folder: str) -> None:
+        """
+        Remove cached diffs older than DIFF_CACHE_MAX_AGE, then the oldest ones beyond DIFF_CACHE_MAX_ENTRIES.
+
+        :param cache_folder: The folder holding the cached diffs.
+        :type cache_folder: str
+        """
+        entries = []
+        with os.scandir(cache_folder) as it:
+            for entry in it:
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    # Removed by a concurrent request in the meantime
+                    continue
+        entries.sort(reverse=True)
+        oldest_allowed = time.time() - DIFF_CACHE_MAX_AGE
+        for index, (modified, path) in enumerate(entries):
+            if index >= DIFF_CACHE_MAX_ENTRIES or modified < oldest_allowed:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+
+    def diff_cache_file(self, base_path: str, file_ok: str, file_fail: str, to_view: bool) -> str:
+        """
+        Get the path under which the HTML diff of this result file is cached.
+
+        :param base_path: The base path for the files location.
+        :type base_path: str
+        :param file_ok: The path of the expected output file.
+        :type file_ok: str
+        :param file_fail: The path of the obtained output file.
+        :type file_fail: str
+        :param to_view: True if the diff is to be viewed in browser, False if it is to be downloaded.
+        :type to_view: bool
+        :return: The path of the cache file.
+        :rtype: str
+        """
+        key = f"{DIFF_CACHE_VERSION}|{self.expected}|{self.got}|{self.regression_test_output_id}|{to_view}|" \
+              f"{os.stat(file_ok).st_mtime_ns}|{os.stat(file_fail).st_mtime_ns}"
+        return os.path.join(base_path, DIFF_CACHE_FOLDER, hashlib.blake2b(key.encode('utf8')).hexdigest() + '.html')
 
     @staticmethod
     def read_lines(file_name: str) -> List[str]:
@@ -451,7 +660,8 @@ class TestResultFile(Base):
         :return: A list of lines.
         :rtype: List[str]
         """
-        try:
-            return open(file_name, encoding='utf8').readlines()
-        except UnicodeDecodeError:
-            return open(file_name, encoding='cp1252').readlines()
+        with open(file_name, 'rb') as f:
+            data = f.read()
+        text = _decode_result(data)
+        # Split like a text-mode file would, translating all newline styles to \n
+        return io.StringIO(text, newline=None).readlines()
@@ -18,15 +18,31 @@ def compress(s: str) -> List[str]:
     return re.split(r'(\W)', s)
 
 
+def common_runs(a: List[str], b: List[str]) -> List[List[int]]:
+    """Get, for every pair of positions, the number of equal items starting at a[i] and b[j]."""
+    runs = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(len(a) - 1, -1, -1):
+        row, next_row, item = runs[i], runs[i + 1], a[i]
+        for j in range(len(b) - 1, -1, -1):
+            if item == b[j]:
+                row[j] = next_row[j + 1] + 1
+    return runs
+
+
 def eq(a: List[str], b: List[str], same_regions: Optional[List[List[int]]] = None,
        delta_a: int = 0, delta_b: int = 0) -> Union[List[int], List[Union[int, List[str]]]]:
     """Implement equality factor."""
-    if index.get(zip_(a), dict()).get(zip_(b), None) is None:
+    key_a = zip_(a)
+    key_b = zip_(b)
+    if index.get(key_a, dict()).get(key_b, None) is None:
         e = 0
         rez = []    # type: Union[int, Any, List[str]]
         best_len, a_iter, b_iter = -1, -1, -1
         find = False
-        for line in range(min(len(a), len(b)), 0, -1):
+        runs = common_runs(a, b)
+        # no common region can be longer than the longest run, so start looking from there
+        longest_run = max(max(row) for row in runs)
+        for line in range(longest_run, 0, -1):
             if find:
                 break
 
@@ -34,31 +50,31 @@ def eq(a: List[str], b: List[str], same_regions: Optional[List[List[int]]] = Non
                 if find:
                     break
 
+                row = runs[i]
                 for j in range(len(b) - line + 1):
-                    if a[i:i + line] != b[j:j + line]:
+                    if row[j] < line:
                         continue
 
                     find = True
                     sub_a_beg = a[0:i]
                     sub_b_beg = b[0:j]
-                    _e1 = eq(sub_a_beg, sub_b_beg)[0]
+                    eq_beg = eq(sub_a_beg, sub_b_beg)
                     sub_a_end = a[i + line:]
                     sub_b_end = b[j + line:]
-                    _e2 = eq(sub_a_end, sub_b_end)[0]
+                    eq_end = eq(sub_a_end, sub_b_end)
 
-                    if _e1 + _e2 + line > e:   # type: ignore
-                        e = _e1 + _e2 + line   # type: ignore
+                    if eq_beg[0] + eq_end[0] + line > e:   # type: ignore
+                        e = eq_beg[0] + eq_end[0] + line   # type: ignore
                         best_len = line
                         a_iter = i
                         b_iter = j
-                        rez = (eq(sub_a_beg, sub_b_beg)[1] + a[i: i + line] + eq(sub_a_end,  # type: ignore
-                                                                                 sub_b_end)[1])
+                        rez = eq_beg[1] + a[i: i + line] + eq_end[1]  # type: ignore
 
-        index[zip_(a)] = index.get(zip_(a), dict())
-        index[zip_(a)][zip_(b)] = [e, rez, a_iter, b_iter, best_len]
+        index[key_a] = index.get(key_a, dict())
+        index[key_a][key_b] = [e, rez, a_iter, b_iter, best_len]
 
-    if same_regions is not None and index[zip_(a)][zip_(b)][0] > 1:
-        a_iter, b_iter, best_len = index[zip_(a)][zip_(b)][2:]
+    if same_regions is not None and index[key_a][key_b][0] > 1:
+        a_iter, b_iter, best_len = index[key_a][key_b][2:]
         # print(delta)
         same_regions.append([
             a_iter + delta_a, a_iter + best_len + delta_a,
@@ -72,7 +88,7 @@ def eq(a: List[str], b: List[str], same_regions: Optional[List[List[int]]] = Non
         eq(sub_a_beg, sub_b_beg, same_regions, delta_a, delta_b)
         eq(sub_a_end, sub_b_end, same_regions, delta_a + a_iter + best_len, delta_b + b_iter + best_len)
 
-    return index[zip_(a)][zip_(b)]
+    return index[key_a][key_b]
 
 
 def _process(test_result: str, correct: str, suffix_id: str) -> Tuple[str, str]:
@@ -464,6 +464,18 @@ class TestControllers(BaseTestCase):
         customized_test = test.get_customized_regressiontests()
         self.assertIn(2, customized_test)
         self.assertNotIn(1, customized_test)
+        self.assertEqual(tuple(test.iter_customized_regressiontest_ids()), customized_test)
+
+    def test_regressiontest_ids_without_customization(self):
+        """Test that a test without customized tests runs all regression tests, looked up once per request."""
+        test = Test.query.filter(Test.id == 1).first()
+        g.pop('all_regression_ids', None)
+
+        regression_ids = tuple(test.iter_customized_regressiontest_ids())
+
+        self.assertEqual(set(regression_ids), {1, 2})
+        self.assertEqual(g.all_regression_ids, regression_ids)
+        self.assertEqual(test.get_customized_regressiontests(), regression_ids)
 
     @mock.patch('mailer.Mailer')
     @mock.patch('mod_ci.controllers.get_html_issue_body')
@@ -0,0 +1,231 @@
+import os
+import tempfile
+import time
+from datetime import timezone
+from unittest import mock
+
+from flask import g
+from sqlalchemy import event
+
+from mod_regression.models import RegressionTestOutput
+from mod_test.models import (DIFF_CACHE_FOLDER, DIFF_CACHE_MAX_AGE,
+                             DIFF_CACHE_VERSION, Test, TestProgress,
+                             TestResultFile, TestStatus, _TokenPool)
+from tests.base import BaseTestCase
+
+
+class TestModels(BaseTestCase):
+    """Test test models."""
+
+    def record_statements(self):
+        """Record the SQL statements executed until the end of the test."""
+        statements = []
+
+        def log_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = g.db.get_bind()
+        event.listen(engine, 'before_cursor_execute', log_statement)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', log_statement)
+        return statements
+
+    def test_progress_data_cache(self):
+        """Test that the cached progress report is not shared with callers and is rebuilt when progress is added."""
+        test = Test.query.filter(Test.id == 2).first()
+
+        report = test.progress_data()
+        report['progress']['step'] = 100
+        self.assertNotEqual(test.progress_data()['progress']['step'], 100)
+
+        g.db.add(TestProgress(2, TestStatus.canceled, "Test 2 canceled"))
+        g.db.commit()
+        test = Test.query.filter(Test.id == 2).first()
+        self.assertEqual(test.progress_data()['progress'], {'state': 'error', 'step': 3})
+
+    def test_repr_expired(self):
+        """Test that representing an expired test or fork does not reload it from the database."""
+        test = Test.query.filter(Test.id == 1).first()
+        fork = test.fork
+        fork_id = fork.id
+        g.db.commit()
+        statements = self.record_statements()
+
+        self.assertEqual(repr(test), '<TestEntry 1>')
+        self.assertEqual(repr(fork), f'<Fork {fork_id}>')
+        self.assertEqual(statements, [])
+
+    def test_all_regression_ids_cached(self):
+        """Test that the ids of all regression tests are only queried once per app context."""
+        g.pop('all_regression_ids', None)
+        statements = self.record_statements()
+
+        first = Test._all_regression_ids()
+        second = Test._all_regression_ids()
+
+        self.assertEqual(set(first), {1, 2})
+        self.assertEqual(second, first)
+        self.assertEqual(len(statements), 1)
+
+    @mock.patch('mod_test.models.has_app_context', return_value=False)
+    def test_all_regression_ids_without_app_context(self, mock_has_app_context):
+        """Test that the ids of all regression tests are queried on every call outside an app context."""
+        statements = self.record_statements()
+
+        Test._all_regression_ids()
+        Test._all_regression_ids()
+
+        self.assertEqual(len(statements), 2)
+
+    def test_progress_timestamp_utc(self):
+        """Test that progress timestamps loaded from the database are timezone aware and in UTC."""
+        g.db.expire_all()
+
+        progress = TestProgress.query.filter(TestProgress.test_id == 1).first()
+        timestamp = g.db.query(TestProgress.timestamp).filter(TestProgress.test_id == 1).first()[0]
+
+        for value in [progress.timestamp, timestamp]:
+            self.assertEqual(value.tzinfo, timezone.utc)
+
+    def test_create_token_length(self):
+        """Test that created tokens have the requested length and are URL safe, also for odd lengths."""
+        for length in [1, 2, 3, 5, 63, 64, 65]:
+            token = Test.create_token(length)
+
+            self.assertEqual(len(token), length)
+            self.assertRegex(token, r'^[A-Za-z0-9_-]+$')
+
+    @mock.patch('mod_test.models.os.urandom', side_effect=lambda size: bytes(size))
+    def test_token_pool_refill(self, mock_urandom):
+        """Test that the token pool refills once fewer bytes remain than are requested."""
+        pool = _TokenPool()
+
+        pool.take(_TokenPool.refill_size - 4)
+        self.assertEqual(len(pool.take(8)), 8)
+        self.assertEqual(len(pool.take(_TokenPool.refill_size + 1)), _TokenPool.refill_size + 1)
+
+        self.assertEqual(mock_urandom.call_args_list, [
+            mock.call(_TokenPool.refill_size), mock.call(_TokenPool.refill_size),
+            mock.call(_TokenPool.refill_size + 1)
+        ])
+
+    @mock.patch('mod_test.models.os.getpid', return_value=1)
+    @mock.patch('mod_test.models.os.urandom', side_effect=[b'a' * 4096, b'b' * 4096])
+    def test_token_pool_reset_after_fork(self, mock_urandom, mock_getpid):
+        """Test that a forked process refills the token pool instead of reusing the bytes of its parent."""
+        pool = _TokenPool()
+        parent = pool.take(4)
+        mock_getpid.return_value = 2
+
+        child = pool.take(4)
+
+        self.assertEqual(parent, b'aaaa')
+        self.assertEqual(child, b'bbbb')
+        self.assertEqual(mock_urandom.call_count, 2)
+
+    def test_read_lines_utf8(self):
+        """Test reading lines of a UTF-8 encoded result file."""
+        with mock.patch('builtins.open', mock.mock_open(read_data='caf\u00e9\r\nline 2\n'.encode('utf8'))):
+            lines = TestResultFile.read_lines('result.txt')
+
+        self.assertEqual(lines, ['caf\u00e9\n', 'line 2\n'])
+
+    def test_read_lines_cp1252(self):
+        """Test reading lines of a result file that is not valid UTF-8."""
+        with mock.patch('builtins.open', mock.mock_open(read_data=b'caf\xe9\nline 2')) as mock_file:
+            lines = TestResultFile.read_lines('result.txt')
+
+        self.assertEqual(lines, ['caf\u00e9\n', 'line 2'])
+        mock_file.assert_called_once_with('result.txt', 'rb')
+
+    def test_read_lines_utf16_bom(self):
+        """Test reading lines of a result file that starts with a UTF-16 byte order mark."""
+        with mock.patch('builtins.open', mock.mock_open(read_data='caf\u00e9\nline 2'.encode('utf-16'))):
+            lines = TestResultFile.read_lines('result.txt')
+
+        self.assertEqual(lines, ['caf\u00e9\n', 'line 2'])
+
+    @staticmethod
+    def create_result_file(base_path):
+        """Create a result file with expected and obtained output files in base_path."""
+        for name in ['expected.srt', 'got.srt']:
+            with open(os.path.join(base_path, name), 'w') as f:
+                f.write(f"{name}\n")
+        result_file = TestResultFile(1, 1, 1, 'expected', 'got')
+        result_file.regression_test_output = RegressionTestOutput(1, 'expected', '.srt', 'expected.srt')
+        return result_file
+
+    @mock.patch('mod_test.models.diff')
+    def test_generate_html_diff_cached(self, mock_diff):
+        """Test that a generated diff is cached and served again without regenerating it."""
+        mock_diff.get_html_diff.return_value = '<table></table>'
+        with tempfile.TemporaryDirectory() as base_path:
+            result_file = self.create_result_file(base_path)
+
+            first = result_file.generate_html_diff(base_path)
+            second = result_file.generate_html_diff(base_path)
+
+        self.assertEqual(first, '<table></table>')
+        self.assertEqual(second, first)
+        mock_diff.get_html_diff.assert_called_once_with(['expected.srt\n'], ['got.srt\n'], True)
+
+    @mock.patch('mod_test.models.diff')
+    def test_generate_html_diff_cache_version(self, mock_diff):
+        """Test that diffs cached for an older diff format are generated again."""
+        mock_diff.get_html_diff.return_value = '<table></table>'
+        with tempfile.TemporaryDirectory() as base_path:
+            result_file = self.create_result_file(base_path)
+
+            result_file.generate_html_diff(base_path)
+            with mock.patch('mod_test.models.DIFF_CACHE_VERSION', DIFF_CACHE_VERSION + 1):
+                result_file.generate_html_diff(base_path)
+
+        self.assertEqual(mock_diff.get_html_diff.call_count, 2)
+
+    @mock.patch('mod_test.models.diff')
+    def test_generate_html_diff_cache_pruned(self, mock_diff):
+        """Test that a diff is generated again when its cached copy is removed before it can be read."""
+        mock_diff.get_html_diff.return_value = '<table></table>'
+        with tempfile.TemporaryDirectory() as base_path:
+            result_file = self.create_result_file(base_path)
+            result_file.generate_html_diff(base_path)
+            real_open = open
+
+            def open_after_prune(file, mode='r', *args, **kwargs):
+                # Simulate another request pruning the cached diff right before it is read
+                if mode == 'r' and os.path.dirname(file).endswith(DIFF_CACHE_FOLDER):
+                    os.remove(file)
+                return real_open(file, mode, *args, **kwargs)
+
+            with mock.patch('builtins.open', side_effect=open_after_prune):
+                html_diff = result_file.generate_html_diff(base_path)
+
+        self.assertEqual(html_diff, '<table></table>')
+        self.assertEqual(mock_diff.get_html_diff.call_count, 2)
+
+    @mock.patch('mod_test.models.os.replace', side_effect=OSError)
+    @mock.patch('mod_test.models.diff')
+    def test_generate_html_diff_cache_write_error(self, mock_diff, mock_replace):
+        """Test that a diff is still returned and no temporary file is left behind when caching fails."""
+        mock_diff.get_html_diff.return_value = '<table></table>'
+        with tempfile.TemporaryDirectory() as base_path:
+            result_file = self.create_result_file(base_path)
+
+            html_diff = result_file.generate_html_diff(base_path)
+
+            self.assertEqual(html_diff, '<table></table>')
+            self.assertEqual(os.listdir(os.path.join(base_path, DIFF_CACHE_FOLDER)), [])
+
+    def test_prune_diff_cache(self):
+        """Test that expired and surplus cached diffs are removed, newest first kept."""
+        now = time.time()
+        with tempfile.TemporaryDirectory() as cache_folder:
+            for name, age in [('new', 10), ('older', 20), ('oldest', 30), ('expired', DIFF_CACHE_MAX_AGE + 60)]:
+                path = os.path.join(cache_folder, f'{name}.html')
+                with open(path, 'w') as f:
+                    f.write(name)
+                os.utime(path, (now - age, now - age))
+
+            with mock.patch('mod_test.models.DIFF_CACHE_MAX_ENTRIES', 2):
+                TestResultFile.prune_diff_cache(cache_folder)
+
+            self.assertEqual(sorted(os.listdir(cache_folder)), ['new.html', 'older.html'])